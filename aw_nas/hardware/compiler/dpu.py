@@ -7,11 +7,12 @@ import re
 import sys
 import shutil
 import subprocess
-from collections import namedtuple
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 import torch
-from torch.autograd import Variable
 
 from aw_nas import utils
 from aw_nas.main import _init_component
@@ -45,6 +46,31 @@ layer {
     batch_size: 50
     new_height: 256
     new_width: 256
+    prefetch: 4
+  }
+}
+"""
+
+# used when `calib_lmdb` is provided: LMDB random-access reads are much faster
+# than per-image JPEG decode, and prefetching overlaps IO with the forwards
+CAFFE_LMDB_DATA_LAYER_STR = """
+layer {
+  name: "data"
+  type: "Data"
+  top: "data"
+  top: "label"
+  transform_param {
+    crop_size: INPUT_SIZE
+    mean_value: 103.53
+    mean_value: 116.28
+    mean_value: 123.675
+    use_standard_std: true
+  }
+  data_param {
+    source: "CALIB_LMDB"
+    backend: LMDB
+    batch_size: 50
+    prefetch: 4
   }
 }
 """
@@ -57,7 +83,8 @@ class DPUCompiler(BaseHardwareCompiler):
 
     NAME = "dpu"
 
-    def __init__(self, dcf=None, mode="debug", calib_iter=0, gpu=0, input_size=None):
+    def __init__(self, dcf=None, mode="debug", calib_iter=0, gpu=0, input_size=None,
+                 calib_lmdb=None, use_onnx=False):
         super(DPUCompiler, self).__init__()
 
         expect(input_size is not None, "must specificy `input_size`", ConfigException)
@@ -67,15 +94,71 @@ class DPUCompiler(BaseHardwareCompiler):
         self._debug_output = _LEVEL <= logging.DEBUG  # debug output
         self.gpu = gpu
         self.input_size = input_size
+        self.calib_lmdb = calib_lmdb
+        # export through onnx (constant folding, fused graph) + MMdnn instead of
+        # the call-tracing pytorch_to_caffe submodule; needs torch >= 1.5 & mmdnn
+        self.use_onnx = use_onnx
+
+    def _run_and_tee(self, cmd, log_file, abort_patterns=()):
+        # run `cmd`, draining its output into `log_file` (and the debug log) as
+        # it is produced; kill the subprocess as soon as a line matches one of
+        # `abort_patterns` instead of letting a doomed run block to completion
+        proc = subprocess.Popen(
+            cmd,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=1,
+            universal_newlines=True,
+        )
+        tail = deque(maxlen=100)
+        abort_lines = []
+
+        def _drain():
+            with open(log_file, "w") as logf:
+                for line in proc.stdout:
+                    logf.write(line)
+                    tail.append(line)
+                    self.logger.debug(line.rstrip())
+                    if any(pat in line for pat in abort_patterns):
+                        abort_lines.append(line)
+                        proc.kill()
+                        return
+
+        drainer = threading.Thread(target=_drain)
+        drainer.start()
+        ret = proc.wait()
+        drainer.join()
+        if abort_lines:
+            raise RuntimeError(
+                "`{}` aborted on output: {}".format(cmd, abort_lines[0].rstrip())
+            )
+        if ret != 0:
+            raise subprocess.CalledProcessError(ret, cmd)
+        return list(tail)
 
     def _run_pytorch_to_caffe(self, model, name, output_dir, input_size, debug):
         self.logger.info("-------- Run pytorch to caffe --------")
-        inputs = Variable(torch.ones([1, 3, input_size, input_size]))
+        # fold Conv+BN pairs in blocks that support fusing, so the traced graph
+        # (and thus the generated prototxt) contains fewer layers
+        model.eval()
+        for mod in list(model.modules()):
+            if hasattr(mod, "fuse"):
+                mod.fuse()
+        inputs = torch.zeros([1, 3, input_size, input_size])
+        if hasattr(torch, "channels_last"):
+            # NHWC layout: memory-bound 1x1/depthwise convs run noticeably
+            # faster during tracing/calibration (torch >= 1.5 only)
+            model = model.to(memory_format=torch.channels_last)
+            inputs = inputs.to(memory_format=torch.channels_last)
 
         if not debug:
             backup_stdout = sys.stdout
             sys.stdout = open("/dev/null", "w")
-        pytorch_to_caffe.trans_net(model, inputs, name)
+        # the trace never calls backward; skip autograd bookkeeping and the
+        # saved-for-backward buffers of every conv/bn in the graph
+        with torch.no_grad():
+            pytorch_to_caffe.trans_net(model, inputs, name)
         if not debug:
             sys.stdout = backup_stdout
 
@@ -106,6 +189,37 @@ class DPUCompiler(BaseHardwareCompiler):
         )
         return out_proto, out_caffemodel, pytorch_to_caffe.torch_to_caffe_names
 
+    def _run_onnx_to_caffe(self, model, name, output_dir, input_size, debug):
+        self.logger.info("-------- Run onnx to caffe --------")
+        utils.makedir(output_dir)
+        onnx_path = "{}/{}.onnx".format(output_dir, name)
+        inputs = torch.ones([1, 3, input_size, input_size])
+        # constant folding removes the no-op layers the call-tracing converter
+        # would otherwise serialize one by one
+        torch.onnx.export(
+            model.eval(),
+            inputs,
+            onnx_path,
+            opset_version=11,
+            do_constant_folding=True,
+            keep_initializers_as_inputs=True,
+        )
+        out_proto = "{}/{}.prototxt".format(output_dir, name)
+        out_caffemodel = "{}/{}.caffemodel".format(output_dir, name)
+        subprocess.check_call(
+            "mmconvert -sf onnx -iw {} -df caffe -om {}/{}".format(
+                onnx_path, output_dir, name
+            ),
+            shell=True,
+        )
+        self.logger.info(
+            "Finish convert pytorch model to caffe through onnx, check {} and {}.".format(
+                out_proto, out_caffemodel
+            )
+        )
+        # the onnx path provides no torch-layer to caffe-layer name mapping
+        return out_proto, out_caffemodel, {}
+
     def _caffe_fix(
         self, prototxt, caffemodel, output_dir, gpu, calib_iter, input_size, debug
     ):
@@ -118,19 +232,18 @@ class DPUCompiler(BaseHardwareCompiler):
         # Might cause some archs to end up with wrong output shape.
         # e.g. Resnet50 converted from Pytorch
         input_prototxt = prototxt + ".tofix.prototxt"
-        subprocess.check_call(
-            (
-                "cat {} | sed '/ceil_mode/d' | sed '/input_dim/d' |"
-                " sed '/input:/d' | sed 's/\"blob1\"/\"data\"/' > {}"
-            ).format(prototxt, input_prototxt),
-            shell=True,
-        )
-        with open(input_prototxt, "r") as r_f:
-            content = (
-                CAFFE_DATA_LAYER_STR.replace("INPUT_SIZE", str(input_size)) + r_f.read()
-            )
-        with open(input_prototxt, "w") as w_f:
-            w_f.write(content)
+        # single-pass stream transform (instead of a cat|sed|... pipeline plus
+        # reopening the file to prepend the data layer)
+        if self.calib_lmdb is not None:
+            data_layer_str = CAFFE_LMDB_DATA_LAYER_STR.replace("CALIB_LMDB", self.calib_lmdb)
+        else:
+            data_layer_str = CAFFE_DATA_LAYER_STR
+        with open(prototxt, "r") as r_f, open(input_prototxt, "w") as w_f:
+            w_f.write(data_layer_str.replace("INPUT_SIZE", str(input_size)))
+            for line in r_f:
+                if "ceil_mode" in line or "input_dim" in line or "input:" in line:
+                    continue
+                w_f.write(line.replace('"blob1"', '"data"'))
         self.logger.info(
             "Fixed-point input prototxt saved to {}.".format(input_prototxt)
         )
@@ -142,16 +255,14 @@ class DPUCompiler(BaseHardwareCompiler):
         self.logger.info(
             "Running deephi_fix, log will be saved to {}.".format(log_file)
         )
-        with open(log_file, "w") as logf:
-            subprocess.check_call(
-                (
-                    "/home/foxfi/projects/caffe_dev/build/tools/deephi_fix fix -calib_iter {} "
-                    "-gpu {} -model {} -weights {} -output_dir {}"
-                ).format(calib_iter, gpu, input_prototxt, caffemodel, output_dir),
-                shell=True,
-                stdout=logf,
-                stderr=logf,
-            )
+        self._run_and_tee(
+            (
+                "/home/foxfi/projects/caffe_dev/build/tools/deephi_fix fix -calib_iter {} "
+                "-gpu {} -model {} -weights {} -output_dir {}"
+            ).format(calib_iter, gpu, input_prototxt, caffemodel, output_dir),
+            log_file,
+            abort_patterns=("out of memory", "diverge"),
+        )
         self.logger.info(
             "Finish running deephi_fix, check output dir {}.".format(output_dir)
         )
@@ -202,20 +313,18 @@ class DPUCompiler(BaseHardwareCompiler):
         )
         return output_elf
 
-    def compile(self, compile_name, net_cfg, result_dir):
-        # construct aw_nas final model
-
-        if pytorch_to_caffe is None:
-            self.logger.warn("the submodule pytorch_to_caffe does not exists.")
-            return
-
+    def _stage_trace(self, compile_name, net_cfg, result_dir):
+        # construct aw_nas final model and trace it to caffe
         search_space = _init_component(net_cfg, "search_space")
         assert isinstance(search_space, GeneralSearchSpace)
+        # the pytorch-to-caffe trace below runs a single CPU forward; building
+        # the model on cuda would only upload the weights to drop them again
+        # (calibration runs in deephi's caffe subprocess, not in this process)
         model = _init_component(
             net_cfg,
             "final_model",
             search_space=search_space,
-            device="cuda:{}".format(self.gpu),
+            device="cpu",
         )
 
         rollout = search_space.rollout_from_genotype(
@@ -225,13 +334,26 @@ class DPUCompiler(BaseHardwareCompiler):
         # pytorch to caffe
         input_size = self.input_size
         ptc_out_dir = utils.makedir(os.path.join(result_dir, "pytorch_to_caffe"))
-        proto, caffemodel, torch_to_caffe = self._run_pytorch_to_caffe(
-            model,
-            compile_name,
-            ptc_out_dir,
-            input_size=input_size,
-            debug=self._debug_output,
-        )
+        if self.use_onnx:
+            self.logger.warn(
+                "use_onnx: no torch-layer to caffe-layer name mapping is "
+                "available, the prim-to-name pickle will be empty."
+            )
+            proto, caffemodel, torch_to_caffe = self._run_onnx_to_caffe(
+                model,
+                compile_name,
+                ptc_out_dir,
+                input_size=input_size,
+                debug=self._debug_output,
+            )
+        else:
+            proto, caffemodel, torch_to_caffe = self._run_pytorch_to_caffe(
+                model,
+                compile_name,
+                ptc_out_dir,
+                input_size=input_size,
+                debug=self._debug_output,
+            )
 
         # map prims to torch layers, and combining with torch layer to caffe layer name.
         prims = rollout.genotype_list()
@@ -248,35 +370,86 @@ class DPUCompiler(BaseHardwareCompiler):
         with open("{}/{}_prim2names.pkl".format(ptc_out_dir, compile_name), "wb") as fw:
             pickle.dump(prims_to_caffe_name, fw, pickle.HIGHEST_PROTOCOL)
 
-        try:
-            # caffe fix
-            fix_out_dir = os.path.join(result_dir, "fix")
-            proto, caffemodel = self._caffe_fix(
-                proto,
-                caffemodel,
-                fix_out_dir,
-                self.gpu,
-                self.calib_iter,
-                input_size,
-                debug=self._debug_output,
-            )
+        return proto, caffemodel, prims_to_caffe_name
 
-            # dnnc
-            dnnc_out_dir = os.path.join(result_dir, "dnnc_{}".format(self.mode))
-            self._run_dnnc(
-                compile_name,
-                proto,
-                caffemodel,
-                dnnc_out_dir,
-                self.dcf,
-                self.mode,
-                debug=self._debug_output,
-            )
+    def _stage_fix(self, proto, caffemodel, result_dir):
+        # caffe fix (runs on the GPU through deephi's caffe)
+        fix_out_dir = os.path.join(result_dir, "fix")
+        return self._caffe_fix(
+            proto,
+            caffemodel,
+            fix_out_dir,
+            self.gpu,
+            self.calib_iter,
+            self.input_size,
+            debug=self._debug_output,
+        )
+
+    def _stage_dnnc(self, compile_name, proto, caffemodel, result_dir):
+        # dnnc (CPU-only compilation)
+        dnnc_out_dir = os.path.join(result_dir, "dnnc_{}".format(self.mode))
+        return self._run_dnnc(
+            compile_name,
+            proto,
+            caffemodel,
+            dnnc_out_dir,
+            self.dcf,
+            self.mode,
+            debug=self._debug_output,
+        )
+
+    def compile(self, compile_name, net_cfg, result_dir):
+        if pytorch_to_caffe is None and not self.use_onnx:
+            self.logger.warn("the submodule pytorch_to_caffe does not exists.")
+            return
+
+        proto, caffemodel, prims_to_caffe_name = self._stage_trace(
+            compile_name, net_cfg, result_dir
+        )
+        try:
+            proto, caffemodel = self._stage_fix(proto, caffemodel, result_dir)
+            self._stage_dnnc(compile_name, proto, caffemodel, result_dir)
         except Exception as e:
             self.logger.error(str(e))
 
         return proto, caffemodel, prims_to_caffe_name
 
+    def compile_multiple(self, compile_cfgs):
+        """
+        Pipeline the compilation of multiple candidate nets.
+
+        compile_cfgs: list of (compile_name, net_cfg, result_dir) tuples.
+
+        The three stages (trace / deephi_fix / dnnc) of one net depend on each
+        other, but stages of different nets are independent; each stage is
+        serialized with its own lock (deephi_fix also owns the GPU), so in the
+        steady state net N's dnnc overlaps net N+1's calibration and net N+2's
+        trace.
+        """
+        if pytorch_to_caffe is None and not self.use_onnx:
+            self.logger.warn("the submodule pytorch_to_caffe does not exists.")
+            return []
+
+        stage_locks = [threading.Lock() for _ in range(3)]
+
+        def _pipeline(cfg):
+            compile_name, net_cfg, result_dir = cfg
+            with stage_locks[0]:
+                proto, caffemodel, prims_to_caffe_name = self._stage_trace(
+                    compile_name, net_cfg, result_dir
+                )
+            try:
+                with stage_locks[1]:
+                    proto, caffemodel = self._stage_fix(proto, caffemodel, result_dir)
+                with stage_locks[2]:
+                    self._stage_dnnc(compile_name, proto, caffemodel, result_dir)
+            except Exception as e:
+                self.logger.error(str(e))
+            return proto, caffemodel, prims_to_caffe_name
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            return list(executor.map(_pipeline, compile_cfgs))
+
     def parse_file(
         self,
         prof_result_file,
@@ -1,5 +1,8 @@
 import os
 import math
+from functools import partial
+
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim.lr_scheduler
@@ -11,36 +14,106 @@ from aw_nas.weights_manager.diff_super_net import DiffSuperNet
 from aw_nas.utils.torch_utils import accuracy
 from aw_nas.ops import register_primitive
 
-def weights_init(m, deepth=0, max_depth=2):
-    if deepth > max_depth:
-        return
-    if isinstance(m, torch.nn.Conv2d):
-        torch.nn.init.kaiming_uniform_(m.weight.data)
-        if m.bias is not None:
-            torch.nn.init.constant_(m.bias.data, 0)
-    elif isinstance(m, torch.nn.Linear):
-        m.weight.data.normal_(0, 0.01)
-        if m.bias is not None:
-            m.bias.data.zero_()
-    elif isinstance(m, torch.nn.BatchNorm2d):
-        return
-    elif isinstance(m, torch.nn.ReLU):
-        return
-    elif isinstance(m, torch.nn.Module):
-        deepth += 1
-        for m_ in m.modules():
-            weights_init(m_, deepth)
-    else:
-        raise ValueError("%s is unk" % m.__class__.__name__)
+def _init_conv(m):
+    torch.nn.init.kaiming_uniform_(m.weight.data)
+    if m.bias is not None:
+        torch.nn.init.constant_(m.bias.data, 0)
+
+def _init_linear(m):
+    m.weight.data.normal_(0, 0.01)
+    if m.bias is not None:
+        m.bias.data.zero_()
+
+_INIT_HANDLERS = {
+    "Conv2d": _init_conv,
+    "Linear": _init_linear,
+}
+
+def weights_init(m):
+    # `nn.Module.apply` already walks the whole tree, so no manual recursion
+    # here (the old recursive version visited nested modules multiple times)
+    handler = _INIT_HANDLERS.get(type(m).__name__)
+    if handler is not None:
+        handler(m)
+
+class _DpuFakeQuant(torch.autograd.Function):
+    """
+    Symmetric per-tensor fake quantization matching the DPU fixed-point
+    semantics: signed `bitwidth`-bit integers with a power-of-two scale.
+    Straight-through estimator: gradient 1 inside the clamp range, 0 outside.
+    """
+    @staticmethod
+    def forward(ctx, x, bitwidth):
+        bound = float(2 ** (bitwidth - 1) - 1)
+        max_abs = float(x.abs().max())
+        if max_abs == 0.:
+            ctx.save_for_backward(torch.ones_like(x))
+            return x
+        # scale = 2^-f, with the largest f that still represents max_abs
+        frac_bits = math.floor(math.log(bound / max_abs, 2))
+        scale = 2. ** (-frac_bits)
+        mask = ((x >= (-bound - 1) * scale) & (x <= bound * scale)).to(x.dtype)
+        ctx.save_for_backward(mask)
+        return torch.clamp((x / scale).round(), -bound - 1, bound) * scale
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        mask, = ctx.saved_tensors
+        return grad_output * mask, None
+
+def _make_fake_quant_hook(bitwidth):
+    def hook(module, inputs):
+        return (_DpuFakeQuant.apply(inputs[0], bitwidth),) + tuple(inputs[1:])
+    return hook
 
 class WeightInitDiffSuperNet(DiffSuperNet):
     NAME = "fb_diff_supernet"
     def __init__(self, *args, **kwargs):
+        # opt-in QAT: fake-quantize the input of every conv with DPU int8
+        # semantics, so the searched net is already adapted to the fixed-point
+        # deployment and deephi_fix calibration/retraining can be skipped
+        fake_quant = kwargs.pop("fake_quant", False)
+        fake_quant_bitwidth = kwargs.pop("fake_quant_bitwidth", 8)
         super(WeightInitDiffSuperNet, self).__init__(*args, **kwargs)
         self.apply(weights_init)
+        if fake_quant:
+            num_hooked = 0
+            for mod in self.modules():
+                if isinstance(mod, nn.Conv2d):
+                    mod.register_forward_pre_hook(
+                        _make_fake_quant_hook(fake_quant_bitwidth))
+                    num_hooked += 1
+            self.logger.info("fake_quant: hooked %d conv layers (bitwidth %d)",
+                             num_hooked, fake_quant_bitwidth)
+
+def _fuse_conv_bn(conv, bn):
+    # fold BN into the preceding conv: W' = W * gamma / sqrt(var + eps),
+    # b' = (b - mean) * gamma / sqrt(var + eps) + beta
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size,
+                      stride=conv.stride, padding=conv.padding,
+                      dilation=conv.dilation, groups=conv.groups, bias=True)
+    scale = bn.weight.data / torch.sqrt(bn.running_var + bn.eps)
+    fused.weight.data = conv.weight.data * scale.reshape(-1, 1, 1, 1)
+    if conv.bias is not None:
+        conv_bias = conv.bias.data
+    else:
+        conv_bias = torch.zeros_like(bn.running_mean)
+    fused.bias.data = (conv_bias - bn.running_mean) * scale + bn.bias.data
+    return fused
+
+def _fuse_sequential(seq):
+    # replace adjacent (Conv2d, BatchNorm2d) pairs with a single fused Conv2d,
+    # and make the remaining ReLUs inplace (safe once BN is folded)
+    for ind in range(len(seq)):
+        if ind + 1 < len(seq) and isinstance(seq[ind], nn.Conv2d) \
+           and isinstance(seq[ind + 1], nn.BatchNorm2d):
+            seq[ind] = _fuse_conv_bn(seq[ind], seq[ind + 1])
+            seq[ind + 1] = nn.Identity()
+        elif isinstance(seq[ind], nn.ReLU):
+            seq[ind] = nn.ReLU(inplace=True)
 
 class MobileBlock(nn.Module):
-    def __init__(self, C_in, C_out, kernel_size, stride, expansion, bn=True):
+    def __init__(self, C_in, C_out, kernel_size, stride, expansion, bn=True, depthwise=True):
         super(MobileBlock, self).__init__()
         # assert not bn, "not support bn for now"
         bias_flag = not bn
@@ -57,19 +130,31 @@ class MobileBlock(nn.Module):
         inner_dim = int(C_in * expansion)
         if inner_dim == 0:
             inner_dim = 1
+        # one shared inplace ReLU per block: a single module (and traced node)
+        # instead of three, and the activations are overwritten, not copied
+        relu = nn.ReLU(inplace=True)
         self.op = nn.Sequential(
             nn.Conv2d(C_in, inner_dim, 1, stride=1, padding=0, bias=bias_flag),
             nn.BatchNorm2d(inner_dim),
-            nn.ReLU(inplace=False),
+            relu,
+            # the middle conv of the inverted residual is depthwise;
+            # `depthwise=False` keeps the old full-conv semantics for old checkpoints
             nn.Conv2d(inner_dim, inner_dim, kernel_size, stride=stride,
-                      padding=padding, bias=bias_flag),
+                      padding=padding, groups=inner_dim if depthwise else 1,
+                      bias=bias_flag),
             nn.BatchNorm2d(inner_dim),
-            nn.ReLU(inplace=False),
+            relu,
             nn.Conv2d(inner_dim, C_out, 1, stride=1, padding=0, bias=bias_flag),
             nn.BatchNorm2d(C_out),
         )
-        self.relus = nn.ReLU(inplace=False)
+        self.relus = relu
         self.res_flag = ((C_in == C_out) and (stride == 1))
+    def fuse(self):
+        # fold BN into conv for eval/tracing; call only after `self.eval()`
+        assert not self.training
+        _fuse_sequential(self.op)
+        self.relus = nn.ReLU(inplace=True)
+
     def forward(self, x):
         if self.res_flag:
             return self.relus(self.op(x) + x)
@@ -77,7 +162,7 @@ class MobileBlock(nn.Module):
             return self.relus(self.op(x))
 
 class ResBlock(nn.Module):
-    def __init__(self, C_in, C_out, kernel_size, stride, expansion, bn=True):
+    def __init__(self, C_in, C_out, kernel_size, stride, expansion, bn=True, depthwise=True):
         super(ResBlock, self).__init__()
         #assert not bn, "not support bn for now"
         bias_flag = not bn
@@ -94,25 +179,35 @@ class ResBlock(nn.Module):
         inner_dim = int(C_in * expansion)
         if inner_dim == 0:
             inner_dim = 1
+        # one shared inplace ReLU per block (see MobileBlock)
+        relu = nn.ReLU(inplace=True)
         self.opa = nn.Sequential(
             nn.Conv2d(C_in, inner_dim, 1, stride=1, padding=0, bias=bias_flag),
             nn.BatchNorm2d(inner_dim),
-            nn.ReLU(inplace=False),
-            nn.Conv2d(inner_dim, inner_dim, kernel_size, stride=stride, padding=padding, bias=bias_flag),
+            relu,
+            nn.Conv2d(inner_dim, inner_dim, kernel_size, stride=stride, padding=padding,
+                      groups=inner_dim if depthwise else 1, bias=bias_flag),
             nn.BatchNorm2d(inner_dim),
-            nn.ReLU(inplace=False),
+            relu,
             nn.Conv2d(inner_dim, C_out, 1, stride=1, padding=0, bias=bias_flag),
             nn.BatchNorm2d(C_out),
             )
         self.opb = nn.Sequential(
             nn.Conv2d(C_in, C_in, kernel_size, stride=stride, padding=padding, bias=bias_flag),
             nn.BatchNorm2d(C_in),
-            nn.ReLU(inplace=False),
+            relu,
             nn.Conv2d(C_in, C_out, 1, stride=1, padding=0, bias=bias_flag),
             nn.BatchNorm2d(C_out),
             )
-        self.relus = nn.ReLU(inplace=False)
-  
+        self.relus = relu
+
+    def fuse(self):
+        # fold BN into conv for eval/tracing; call only after `self.eval()`
+        assert not self.training
+        _fuse_sequential(self.opa)
+        _fuse_sequential(self.opb)
+        self.relus = nn.ReLU(inplace=True)
+
     def forward(self, x):
         a = self.opa(x)
         b = self.opb(x)
@@ -122,147 +217,57 @@ class VGGBlock(nn.Module):
     def __init__(self, C_in, C_out, kernel_list, stride, bn=True):
         super(VGGBlock, self).__init__()
         bias_flag = not bn
+        # one shared inplace ReLU per block (see MobileBlock)
+        relu = nn.ReLU(inplace=True)
         tmp_block = []
         for kernel_size in kernel_list:
             padding = int((kernel_size-1)/2)
             tmp_block.append(nn.Conv2d(C_in,C_out,kernel_size,padding=padding,bias=bias_flag))
             tmp_block.append(nn.BatchNorm2d(C_out))
-            tmp_block.append(nn.ReLU(inplace=False))
+            tmp_block.append(relu)
             C_in = C_out
         if stride == 2:
             tmp_block.append(nn.MaxPool2d(2,stride))
         self.op = nn.Sequential(*tmp_block)
-    def forward(self, x):
-        return self.op(x)
-
-#==============VGGNet block================================
-def VGGblock_0(C_in, C_out, stride, affine):
-    return VGGBlock(C_in, C_out, [1], stride, True)
-
-def VGGblock_1(C_in, C_out, stride, affine):
-    return VGGBlock(C_in, C_out, [3], stride, True)
-
-def VGGblock_2(C_in, C_out, stride, affine):
-    return VGGBlock(C_in, C_out, [1,3], stride, True)
-
-def VGGblock_3(C_in, C_out, stride, affine):
-    return VGGBlock(C_in, C_out, [5], stride, True)
-
-def VGGblock_4(C_in, C_out, stride, affine):
-    return VGGBlock(C_in, C_out, [1,5], stride, True)
-
-def VGGblock_5(C_in, C_out, stride, affine):
-    return VGGBlock(C_in, C_out, [3,3], stride, True)
-
-def VGGblock_6(C_in, C_out, stride, affine):
-    return VGGBlock(C_in, C_out, [1,3,3], stride, True)
-
-def VGGblock_7(C_in, C_out, stride, affine):
-    return VGGBlock(C_in, C_out, [7], stride, True)
-
-def VGGblock_8(C_in, C_out, stride, affine):
-    return VGGBlock(C_in, C_out, [1,7], stride, True)
-
-def VGGblock_9(C_in, C_out, stride, affine):
-    return VGGBlock(C_in, C_out, [3,5], stride, True)
-
-def VGGblock_10(C_in, C_out, stride, affine):
-    return VGGBlock(C_in, C_out, [1,3,5], stride, True)
-
-def VGGblock_11(C_in, C_out, stride, affine):
-    return VGGBlock(C_in, C_out, [3,3,3], stride, True)
-
-def VGGblock_12(C_in, C_out, stride, affine):
-    return VGGBlock(C_in, C_out, [1,3,3,3], stride, True)
-
-#==============ResNet block================================
-def Resblock_0(C_in, C_out, stride, affine):
-    return ResBlock(C_in, C_out, 3, stride, 1)
 
-def Resblock_1(C_in, C_out, stride, affine):
-    return ResBlock(C_in, C_out, 5, stride, 1)
+    def fuse(self):
+        # fold BN into conv for eval/tracing; call only after `self.eval()`
+        assert not self.training
+        _fuse_sequential(self.op)
 
-def Resblock_2(C_in, C_out, stride, affine):
-    return ResBlock(C_in, C_out, 7, stride, 1)
-
-def Resblock_3(C_in, C_out, stride, affine):
-    return ResBlock(C_in, C_out, 3, stride, 1./2)
-
-def Resblock_4(C_in, C_out, stride, affine):
-    return ResBlock(C_in, C_out, 5, stride, 1./2)
-
-def Resblock_5(C_in, C_out, stride, affine):
-    return ResBlock(C_in, C_out, 7, stride, 1./2)
-
-def Resblock_6(C_in, C_out, stride, affine):
-    return ResBlock(C_in, C_out, 3, stride, 1./4)
-
-def Resblock_7(C_in, C_out, stride, affine):
-    return ResBlock(C_in, C_out, 5, stride, 1./4)
-
-def Resblock_8(C_in, C_out, stride, affine):
-    return ResBlock(C_in, C_out, 7, stride, 1./4)
-
-
-#==============MobileNet block================================
-def Mobileblock_0(C_in, C_out, stride, affine):
-    return MobileBlock(C_in, C_out, 3, stride, 1)
-
-def Mobileblock_1(C_in, C_out, stride, affine):
-    return MobileBlock(C_in, C_out, 5, stride, 1)
-
-def Mobileblock_2(C_in, C_out, stride, affine):
-    return MobileBlock(C_in, C_out, 7, stride, 1)
-
-def Mobileblock_3(C_in, C_out, stride, affine):
-    return MobileBlock(C_in, C_out, 3, stride, 1./3)
-
-def Mobileblock_4(C_in, C_out, stride, affine):
-    return MobileBlock(C_in, C_out, 5, stride, 1./3)
-
-def Mobileblock_5(C_in, C_out, stride, affine):
-    return MobileBlock(C_in, C_out, 7, stride, 1./3)
-
-def Mobileblock_6(C_in, C_out, stride, affine):
-    return MobileBlock(C_in, C_out, 3, stride, 1./6)
-
-def Mobileblock_7(C_in, C_out, stride, affine):
-    return MobileBlock(C_in, C_out, 5, stride, 1./6)
-
-def Mobileblock_8(C_in, C_out, stride, affine):
-    return MobileBlock(C_in, C_out, 7, stride, 1./6)
+    def forward(self, x):
+        return self.op(x)
 
-register_primitive("Mobileblock_0", Mobileblock_0)
-register_primitive("Mobileblock_1", Mobileblock_1)
-register_primitive("Mobileblock_2", Mobileblock_2)
-register_primitive("Mobileblock_3", Mobileblock_3)
-register_primitive("Mobileblock_4", Mobileblock_4)
-register_primitive("Mobileblock_5", Mobileblock_5)
-register_primitive("Mobileblock_6", Mobileblock_6)
-register_primitive("Mobileblock_7", Mobileblock_7)
-register_primitive("Mobileblock_8", Mobileblock_8)
-register_primitive("Resblock_0", Resblock_0)
-register_primitive("Resblock_1", Resblock_1)
-register_primitive("Resblock_2", Resblock_2)
-register_primitive("Resblock_3", Resblock_3)
-register_primitive("Resblock_4", Resblock_4)
-register_primitive("Resblock_5", Resblock_5)
-register_primitive("Resblock_6", Resblock_6)
-register_primitive("Resblock_7", Resblock_7)
-register_primitive("Resblock_8", Resblock_8)
-register_primitive("VGGblock_0", VGGblock_0)
-register_primitive("VGGblock_1", VGGblock_1)
-register_primitive("VGGblock_2", VGGblock_2)
-register_primitive("VGGblock_3", VGGblock_3)
-register_primitive("VGGblock_4", VGGblock_4)
-register_primitive("VGGblock_5", VGGblock_5)
-register_primitive("VGGblock_6", VGGblock_6)
-register_primitive("VGGblock_7", VGGblock_7)
-register_primitive("VGGblock_8", VGGblock_8)
-register_primitive("VGGblock_9", VGGblock_9)
-register_primitive("VGGblock_10", VGGblock_10)
-register_primitive("VGGblock_11", VGGblock_11)
-register_primitive("VGGblock_12", VGGblock_12)
+#==============block specs================================
+# kernel list per VGG block
+VGG_SPEC = [[1], [3], [1, 3], [5], [1, 5], [3, 3], [1, 3, 3],
+            [7], [1, 7], [3, 5], [1, 3, 5], [3, 3, 3], [1, 3, 3, 3]]
+# (kernel_size, expansion) per Res/Mobile block
+RES_SPEC = [(3, 1.), (5, 1.), (7, 1.),
+            (3, 1./2), (5, 1./2), (7, 1./2),
+            (3, 1./4), (5, 1./4), (7, 1./4)]
+MOBILE_SPEC = [(3, 1.), (5, 1.), (7, 1.),
+               (3, 1./3), (5, 1./3), (7, 1./3),
+               (3, 1./6), (5, 1./6), (7, 1./6)]
+
+def _vgg_block(C_in, C_out, stride, affine, kernel_list):
+    return VGGBlock(C_in, C_out, kernel_list, stride, True)
+
+def _res_block(C_in, C_out, stride, affine, kernel_size, expansion):
+    return ResBlock(C_in, C_out, kernel_size, stride, expansion)
+
+def _mobile_block(C_in, C_out, stride, affine, kernel_size, expansion):
+    return MobileBlock(C_in, C_out, kernel_size, stride, expansion)
+
+for _i, (_kernel, _expansion) in enumerate(MOBILE_SPEC):
+    register_primitive("Mobileblock_{}".format(_i),
+                       partial(_mobile_block, kernel_size=_kernel, expansion=_expansion))
+for _i, (_kernel, _expansion) in enumerate(RES_SPEC):
+    register_primitive("Resblock_{}".format(_i),
+                       partial(_res_block, kernel_size=_kernel, expansion=_expansion))
+for _i, _kernel_list in enumerate(VGG_SPEC):
+    register_primitive("VGGblock_{}".format(_i),
+                       partial(_vgg_block, kernel_list=_kernel_list))
 
 class CosineDecayLR(_LRScheduler):
     def __init__(self, optimizer, T_max, alpha=1e-4,
@@ -278,33 +283,42 @@ class CosineDecayLR(_LRScheduler):
         self.logger = logger
         self.last_restart_step = 0
         self.flag = True
+        # constants of the cosine branch; only change at restart boundaries
+        # (populated lazily, as `get_lr` is called inside `super().__init__`)
+        self._pi_over_t_max = math.pi / self.T_max
+        self._cos_num = None
         super(CosineDecayLR, self).__init__(optimizer, last_epoch)
 
         self.min_lrs = [b_lr * alpha for b_lr in self.base_lrs]
-        self.rise_lrs = [1.0 * (b - m) / self.warmup_step 
+        self.rise_lrs = [1.0 * (b - m) / self.warmup_step
                          for (b, m) in zip(self.base_lrs, self.min_lrs)]
+        self._warmup_params = list(zip(self.min_lrs, self.rise_lrs))
 
     def get_lr(self):
         T_cur = self.last_epoch - self.last_restart_step
         assert T_cur >= 0
         if T_cur <= self.warmup_step and (not self.flag):
             base_lrs = [min_lr + rise_lr * T_cur
-                        for (base_lr, min_lr, rise_lr) in 
-                        zip(self.base_lrs, self.min_lrs, self.rise_lrs)]
+                        for (min_lr, rise_lr) in self._warmup_params]
             if T_cur == self.warmup_step:
                 self.last_restart_step = self.last_epoch
                 self.flag = True
         else:
-            base_lrs = [self.alpha + (base_lr - self.alpha) *
-                        (1 + math.cos(math.pi * self.last_epoch / self.T_max)) / 2
-                        for base_lr in self.base_lrs]
+            if self._cos_num is None:
+                self._cos_num = [(b_lr - self.alpha) * 0.5 for b_lr in self.base_lrs]
+            # call `math.cos` once per step instead of once per param group
+            cos_t = 1 + math.cos(self._pi_over_t_max * self.last_epoch)
+            base_lrs = [self.alpha + c * cos_t for c in self._cos_num]
         if T_cur == self.T_max:
             self.last_restart_step = self.last_epoch
             self.min_lrs = [b_lr * self.alpha for b_lr in self.base_lrs]
             self.base_lrs = [b_lr * self.lr_mul for b_lr in self.base_lrs]
-            self.rise_lrs = [1.0 * (b - m) / self.warmup_step 
+            self.rise_lrs = [1.0 * (b - m) / self.warmup_step
                              for (b, m) in zip(self.base_lrs, self.min_lrs)]
+            self._warmup_params = list(zip(self.min_lrs, self.rise_lrs))
             self.T_max = int(self.T_max * self.t_mul)
+            self._pi_over_t_max = math.pi / self.T_max
+            self._cos_num = [(b_lr - self.alpha) * 0.5 for b_lr in self.base_lrs]
             self.flag = False
         return base_lrs
 
@@ -327,9 +341,47 @@ class LatencyObjective(BaseObjective):
                 self.latency_lut.append([float(x) for x in lat_line.split()])
         self._min_lat = sum([min(lat) for lat in self.latency_lut])
         self._max_lat = sum([max(lat) for lat in self.latency_lut])
+        # stack the per-layer latency lists into one padded [num_layers, max_prims] tensor,
+        # so differentiable-rollout latency can be computed without per-layer host
+        # allocations and host-to-device copies
+        num_layers = len(self.latency_lut)
+        max_prims = max([len(lat) for lat in self.latency_lut])
+        self._lut_cpu = torch.zeros(num_layers, max_prims)
+        for i_layer, lat in enumerate(self.latency_lut):
+            self._lut_cpu[i_layer, :len(lat)] = torch.Tensor(lat)
+        if torch.cuda.is_available():
+            # pinned memory enables async (non_blocking) transfer to each device
+            self._lut_cpu = self._lut_cpu.pin_memory()
+        self._lut_cache = {}
+        # numpy copy of the padded LUT and per-cell-group primitive-name -> column
+        # index mappings, for the discrete-rollout branches
+        self._lut_np = np.array(
+            [lat + [0.] * (max_prims - len(lat)) for lat in self.latency_lut])
+        self._prim_idx = [
+            {prim: idx for idx, prim in enumerate(prims)}
+            for prims in search_space.cell_shared_primitives
+        ]
         self.logger.info("Min possible latency: %.3f; Max possible latency: %.3f",
                          self._min_lat, self._max_lat)
 
+    def _lut(self, device):
+        # per-device cache of the padded latency LUT
+        device = torch.device(device)
+        if device not in self._lut_cache:
+            self._lut_cache[device] = self._lut_cpu.to(device, non_blocking=True)
+        return self._lut_cache[device]
+
+    def _discrete_latency(self, prim_types):
+        # vectorized LUT lookup: one fancy-indexing gather instead of a
+        # per-layer `list.index` scan and float cast
+        cell_layout = self.search_space.cell_layout
+        num_cells = len(prim_types)
+        idx = np.fromiter(
+            (self._prim_idx[cell_layout[i]][geno[0][0]]
+             for i, geno in enumerate(prim_types)),
+            dtype=np.int64, count=num_cells)
+        return float(self._lut_np[np.arange(num_cells), idx].sum())
+
     @classmethod
     def supported_data_types(cls):
         return ["image"]
@@ -340,19 +392,15 @@ class LatencyObjective(BaseObjective):
     def get_perfs(self, inputs, outputs, targets, cand_net):
         acc = float(accuracy(outputs, targets)[0]) / 100
         total_latency = 0.
-        ss = self.search_space
         if cand_net.super_net.rollout_type == "discrete":
             # first half is the primitive type of each cell, second half is the concat nodes
-            num_cells = len(cand_net.genotypes) // 2 
+            num_cells = len(cand_net.genotypes) // 2
             prim_types = cand_net.genotypes[:num_cells]
-            for i_layer, geno in enumerate(prim_types):
-                prim = geno[0][0]
-                prims = ss.cell_shared_primitives[ss.cell_layout[i_layer]]
-                total_latency += float(self.latency_lut[i_layer][prims.index(prim)])
+            total_latency = self._discrete_latency(prim_types)
         else:
             for i_layer, arch in enumerate(cand_net.arch):
                 latency = (arch[0] * \
-                           torch.Tensor(self.latency_lut[i_layer]).to(arch.device)).sum().item()
+                           self._lut(arch.device)[i_layer, :arch[0].shape[-1]]).sum().item()
                 if arch[0].ndimension() == 2:
                     latency /= arch[0].shape[0]
                 total_latency += latency
@@ -361,15 +409,10 @@ class LatencyObjective(BaseObjective):
     def get_reward(self, inputs, outputs, targets, cand_net):
         acc = float(accuracy(outputs, targets)[0]) / 100
         if self.lamb is not None:
-            latency_penalty = 0.
-            ss = self.search_space
             # first half is the primitive type of each cell, second half is the concat nodes
-            num_cells = len(cand_net.genotypes) // 2 
+            num_cells = len(cand_net.genotypes) // 2
             prim_types = cand_net.genotypes[:num_cells]
-            for i_layer, geno in enumerate(prim_types):
-                prim = geno[0][0]
-                prims = ss.cell_shared_primitives[ss.cell_layout[i_layer]]
-                latency_penalty += float(self.latency_lut[i_layer][prims.index(prim)])
+            latency_penalty = self._discrete_latency(prim_types)
             # return acc  + float(self.lamb) / (latency_penalty - self._min_lat + 1.)
             return acc  + float(self.lamb) * (1. / latency_penalty - 1. / self._max_lat)
         return acc
@@ -378,14 +421,26 @@ class LatencyObjective(BaseObjective):
                  add_controller_regularization=True, add_evaluator_regularization=True):
         loss = nn.CrossEntropyLoss()(outputs, targets)
         if add_controller_regularization:
-            # differentiable rollout
-            latency_loss = 0.
-            for i_layer, arch in enumerate(cand_net.arch):
-                latency = (arch[0] * \
-                           torch.Tensor(self.latency_lut[i_layer]).to(arch.device)).sum()
-                if arch[0].ndimension() == 2:
-                    latency = latency / arch[0].shape[0]
-                latency_loss += latency
+            # differentiable rollout: when all layers share the arch-weight shape,
+            # stack them and do one batched multiply-reduce, so autograd records a
+            # single op instead of one small multiply/sum per layer
+            archs = [arch[0] for arch in cand_net.arch]
+            if len(set([a.shape for a in archs])) == 1:
+                stacked = torch.stack(archs)
+                lut = self._lut(stacked.device)[:len(archs), :stacked.shape[-1]]
+                if stacked.ndimension() == 3:
+                    # [num_layers, batch, num_prims]
+                    latency_loss = (stacked * lut.unsqueeze(1)).sum() / stacked.shape[1]
+                else:
+                    latency_loss = (stacked * lut).sum()
+            else:
+                latency_loss = 0.
+                for i_layer, arch_w in enumerate(archs):
+                    latency = (arch_w * \
+                               self._lut(arch_w.device)[i_layer, :arch_w.shape[-1]]).sum()
+                    if arch_w.ndimension() == 2:
+                        latency = latency / arch_w.shape[0]
+                    latency_loss += latency
             loss = loss * self.alpha * (latency_loss).pow(self.beta)
         return loss
 